@@ -1,6 +1,8 @@
 # system imports
 import gettext
+import math
 import typing
+import uuid
 
 import numpy as np
 
@@ -12,11 +14,273 @@ from nion.swift.model import Graphics
 from nion.swift.model import Symbolic
 from nion.swift.model import DocumentModel
 from nion.ui import UserInterface
+from nion.utils import Geometry
+
+try:
+    import numba
+except ImportError:
+    numba = None  # type: ignore[assignment]
+
+try:
+    import cupy
+    # cupy imports fine on machines without a usable GPU; probe once here so the
+    # execute path does not fail (or fall back per call) at runtime
+    if cupy.cuda.runtime.getDeviceCount() < 1:
+        cupy = None
+except Exception:
+    cupy = None
 
 _ = gettext.gettext
 
 _DataArrayType = np.typing.NDArray[typing.Any]
 
+# below this fraction of selected detector pixels the indexed gather touches less
+# memory than streaming the full detector dimension through BLAS
+_SPARSE_MASK_DENSITY = 0.05
+
+# masks whose ravel has at most this many contiguous runs (one per rectangle row,
+# so e.g. a single 64-row rectangle) are summed run by run with plain slices
+_MAX_MASK_RUNS = 64
+
+# target working-set size per scan-grid tile; roughly half a typical L2 cache so a
+# tile of detector frames stays resident while it is reduced
+_L2_TILE_BYTES = 512 * 1024
+
+# datasets at least this large amortize the host-to-device transfer of a GPU
+# reduction; the result coming back is only (Ny, Nx)
+_CUPY_MIN_BYTES = 512 * 1024 * 1024
+
+# the detector-major cache duplicates the source in memory, so only keep it for
+# datasets up to this size
+_SOA_CACHE_MAX_BYTES = 4 * 1024 * 1024 * 1024
+
+# dtypes with an eagerly compiled _sum_masked specialization below; anything else
+# takes the numpy gather fallback
+_SUM_MASKED_DTYPES = frozenset(("float32", "float64", "uint8", "uint16", "int16"))
+
+
+if numba is not None:
+    try:
+        # compile the known specializations at import instead of on first call, so the
+        # first interactive frame does not stall on the JIT; cache=True persists the
+        # machine code across sessions. (numba's pycc AOT compiler is deprecated, so
+        # eager signatures are the supported way to get ahead-of-use compilation.)
+        _sum_masked_signatures = [
+            "void(f4[:, :, ::1], i4[::1], f4[:, ::1])",
+            "void(f8[:, :, ::1], i4[::1], f8[:, ::1])",
+            "void(u1[:, :, ::1], i4[::1], i8[:, ::1])",
+            "void(u2[:, :, ::1], i4[::1], i8[:, ::1])",
+            "void(i2[:, :, ::1], i4[::1], i8[:, ::1])",
+        ]
+
+        @numba.njit(_sum_masked_signatures, parallel=True, fastmath=True, cache=True, boundscheck=False)
+        def _sum_masked(data: _DataArrayType, idx: _DataArrayType, out: _DataArrayType) -> None:
+            # sum the detector pixels selected by idx for each scan position. the outer
+            # loop parallelizes over the scan grid; each position reduces along the
+            # contiguous detector axis into its own output element, so there are no
+            # write conflicts between threads.
+            n = out.shape[0] * out.shape[1]
+            flat = data.reshape(n, data.shape[-1])
+            res = out.reshape(n)
+            # tile the scan grid so each thread works on a block of positions whose
+            # frames fit in L2 instead of striding through the whole cube
+            block = max(1, _L2_TILE_BYTES // (data.shape[-1] * data.itemsize))
+            for b in numba.prange((n + block - 1) // block):  # type: ignore[attr-defined, no-untyped-call]
+                p0 = b * block
+                for p in range(p0, min(p0 + block, n)):
+                    # accumulate in the output dtype so integer input sums into the
+                    # caller's int64 buffer without promotion to float
+                    res[p] = 0
+                    for k in range(idx.shape[0]):
+                        res[p] += flat[p, idx[k]]
+
+        @numba.njit(["void(f8[:, ::1], u1[:, ::1])"], parallel=True, cache=True, boundscheck=False)
+        def _fill_union_mask(descriptors: _DataArrayType, out: _DataArrayType) -> None:
+            # rasterize all described regions into the uint8 union mask in a single
+            # pass, parallel over detector rows; each thread owns whole rows, so no two
+            # threads ever write the same byte. descriptor layout as in
+            # _describe_region below. candidate columns come from the analytic extent
+            # widened by one pixel, and each candidate is tested with the identical
+            # expression Core.function_make_*_mask uses, so boundary pixels match
+            # region.get_mask bit for bit.
+            height, width = out.shape
+            for y in numba.prange(height):  # type: ignore[attr-defined, no-untyped-call]
+                for r in range(descriptors.shape[0]):
+                    a = descriptors[r, 1]
+                    b = descriptors[r, 2]
+                    hh = descriptors[r, 3]
+                    hw = descriptors[r, 4]
+                    dy = y - a
+                    if descriptors[r, 0] == 0.0:
+                        if abs(dy) / hh <= 1.0:
+                            x0 = max(int(math.ceil(b - hw)) - 1, 0)
+                            x1 = min(int(math.floor(b + hw)) + 1, width - 1)
+                            for x in range(x0, x1 + 1):
+                                if abs(x - b) / hw <= 1.0:
+                                    out[y, x] = 1
+                    else:
+                        dy2 = dy * dy / (hh * hh)
+                        if dy2 <= 1.0:
+                            half = hw * math.sqrt(1.0 - dy2)
+                            x0 = max(int(math.ceil(b - half)) - 1, 0)
+                            x1 = min(int(math.floor(b + half)) + 1, width - 1)
+                            for x in range(x0, x1 + 1):
+                                if (x - b) * (x - b) / (hw * hw) + dy2 <= 1.0:
+                                    out[y, x] = 1
+
+        # same eagerly compiled dtypes as _sum_masked; the sparse path only calls this
+        # kernel for those, so no compilation ever happens at call time
+        _tiled_transpose_signatures = [
+            "void(f4[:, :, ::1], f4[:, :, ::1])",
+            "void(f8[:, :, ::1], f8[:, :, ::1])",
+            "void(u1[:, :, ::1], u1[:, :, ::1])",
+            "void(u2[:, :, ::1], u2[:, :, ::1])",
+            "void(i2[:, :, ::1], i2[:, :, ::1])",
+        ]
+
+        @numba.njit(_tiled_transpose_signatures, parallel=True, cache=True, boundscheck=False)
+        def _tiled_transpose_to_soa(src: _DataArrayType, dst: _DataArrayType) -> None:
+            # copy src (Ny, Nx, Nd) to dst (Nd, Ny, Nx) in 32x32 tiles. a naive
+            # transpose thrashes the cache when the strides are powers of two; tiling
+            # keeps both the read and the write side of a tile resident while it is
+            # copied. 32 * 32 elements fit L1 comfortably for every supported itemsize.
+            ny, nx, nd = src.shape
+            t = 32
+            for bk in numba.prange((nd + t - 1) // t):  # type: ignore[attr-defined, no-untyped-call]
+                k0 = bk * t
+                k1 = min(k0 + t, nd)
+                for y in range(ny):
+                    for x0 in range(0, nx, t):
+                        for x in range(x0, min(x0 + t, nx)):
+                            for k in range(k0, k1):
+                                dst[k, y, x] = src[y, x, k]
+    except Exception:
+        # compilation (or loading numba's on-disk cache, which records the
+        # import-time module name and so can go stale between a test run and a
+        # normal plugin import) can fail for reasons the ImportError guard above
+        # does not cover; treat any failure here as numba being unavailable so
+        # the plugin still imports and the numpy fallbacks take over
+        numba = None  # type: ignore[assignment]
+
+
+
+_RegionDescriptor = typing.Tuple[float, float, float, float, float]
+
+
+def _region_signature(region: Graphics.Graphic) -> typing.Any:
+    """Return a value describing the region's content, for cache keying.
+
+    At runtime the computation receives fresh Graphics.RegionBase snapshots on
+    every evaluation, so object identity never repeats and a content-based key is
+    the only one that can hit. The snapshot attributes (bounds, rotation, radii,
+    ...) are stringified so the signature compares cheaply and reliably.
+    """
+    if isinstance(region, Graphics.RegionBase):
+        return (type(region).__name__, tuple((name, str(value)) for name, value in vars(region).items()))
+    # a model-level graphic (e.g. when called directly from tests): key on its
+    # identity plus modified time, which changes with any property edit
+    return (type(region).__name__, id(region), getattr(region, "modified", None))
+
+
+_RECTANGLE_REGION_TYPES = (Graphics.RectangleGraphic, Graphics.RectangleRegion)
+_ELLIPSE_REGION_TYPES = (Graphics.EllipseGraphic, Graphics.EllipseRegion)
+
+
+def _describe_region(mask_shape: typing.Tuple[int, ...], region: Graphics.Graphic) -> _RegionDescriptor | None:
+    """Reduce a common axis-aligned shape to a rasterization descriptor.
+
+    The descriptor is (kind, a, b, hh, hw) with kind 0.0 for a rectangle and 1.0
+    for an ellipse; (a, b) is the pixel center offset by -0.5 and (hh, hw) are
+    the pixel half extents, exactly the quantities Core.function_make_*_mask
+    rasterizes from. None means the region needs the generic Graphics
+    rasterizer, which materializes a full-size mask per region before it can be
+    ORed in. Handles both model graphics and the per-evaluation RegionBase
+    snapshots the computation actually receives.
+    """
+    if not isinstance(region, _RECTANGLE_REGION_TYPES + _ELLIPSE_REGION_TYPES) or region.rotation:
+        return None
+    height, width = mask_shape
+    bounds = Geometry.FloatRect.make(region.bounds)
+    # replicate Core's mapping into pixel coordinates step for step so the
+    # resulting masks are identical to region.get_mask down to boundary pixels
+    data_rect = Geometry.FloatRect(origin=Geometry.FloatPoint(), size=Geometry.FloatSize(height=height, width=width))
+    center_point = Geometry.map_point(bounds.center, Geometry.FloatRect.unit_rect(), data_rect)
+    size_size = Geometry.map_size(bounds.size, Geometry.FloatRect.unit_rect(), data_rect)
+    pixel_bounds = Geometry.FloatRect.from_center_and_size(center_point, size_size)
+    hh = pixel_bounds.height / 2
+    hw = pixel_bounds.width / 2
+    if isinstance(region, _RECTANGLE_REGION_TYPES):
+        a = pixel_bounds.top + pixel_bounds.height * 0.5 - 0.5
+        b = pixel_bounds.left + pixel_bounds.width * 0.5 - 0.5
+        return 0.0, a, b, hh, hw
+    if pixel_bounds.height <= 0 or pixel_bounds.width <= 0:
+        return 0.0, 0.0, 0.0, 0.0, 0.0  # degenerate ellipse: rasterizes to nothing
+    return 1.0, pixel_bounds.center.y - 0.5, pixel_bounds.center.x - 0.5, hh, hw
+
+
+def _fill_descriptor_mask(mask_data: _DataArrayType, descriptor: _RegionDescriptor) -> None:
+    # numpy fallback used when numba is unavailable: rasterize one descriptor
+    # directly into the union mask buffer, using Core's exact inside tests
+    kind, a, b, hh, hw = descriptor
+    height, width = mask_data.shape
+    # integer grids shifted by the offsets give the same values as Core's float
+    # ogrid without its occasional off-by-one row from float range arithmetic
+    iy, ix = np.ogrid[:height, :width]
+    y = iy - a
+    x = ix - b
+    if kind == 0.0:
+        inside = (np.fabs(x) / hw <= 1) & (np.fabs(y) / hh <= 1)
+    else:
+        inside = x * x / (hw * hw) + y * y / (hh * hh) <= 1
+    np.bitwise_or(mask_data, inside, out=mask_data)
+
+
+class _MapCache:
+    """Cache state for one map computation, persisted across evaluations.
+
+    The computation framework constructs a fresh handler instance for every
+    evaluation, so state held on the handler never survives a single frame.
+    The union mask and its derived arrays therefore live here, keyed at module
+    scope by the computation uuid, so live Pick updates actually reuse them.
+    """
+
+    def __init__(self) -> None:
+        self.mask_sig: tuple[typing.Any, ...] | None = None
+        self.mask_data: _DataArrayType | None = None
+        self.mask_count = 0
+        self.mask_idx: _DataArrayType | None = None
+        self.mask_weights: _DataArrayType | None = None
+        self.mask_runs: _DataArrayType | None = None
+        # the (Ny, Nx) scratch buffer the reductions write into, reused across
+        # evaluations so steady-state ticks do not allocate; recreated only when
+        # the scan shape or accumulator dtype changes
+        self.out: _DataArrayType | None = None
+        # the committed result wrapper, reused while shape, dtype and calibrations
+        # match so live updates skip the constructor (and its copy) on every frame
+        self.new_xdata: DataAndMetadata.DataAndMetadata | None = None
+        # optional detector-major copy of the source, shape (Nd, Ny, Nx); built
+        # once the same source recurs so repeated sparse masks read contiguous
+        # planes instead of strided per-position gathers
+        self.data_T: _DataArrayType | None = None
+        self.data_T_sig: tuple[typing.Any, ...] | None = None
+        self.last_src_sig: tuple[typing.Any, ...] | None = None
+
+
+# bounded so deleted computations cannot pin detector-sized arrays forever; the
+# oldest entry is evicted first, which is harmless (it only costs a rebuild)
+_MAX_MAP_CACHES = 8
+_map_caches: typing.Dict[uuid.UUID, _MapCache] = dict()
+
+
+def _get_map_cache(computation_uuid: uuid.UUID) -> _MapCache:
+    cache = _map_caches.get(computation_uuid)
+    if cache is None:
+        while len(_map_caches) >= _MAX_MAP_CACHES:
+            _map_caches.pop(next(iter(_map_caches)))
+        cache = _MapCache()
+        _map_caches[computation_uuid] = cache
+    return cache
+
 
 class Map4D:
     label = _("Map 4D")
@@ -24,6 +288,10 @@ class Map4D:
 
     def __init__(self, computation: Facade.Computation, **kwargs: typing.Any) -> None:
         self.computation = computation
+        # execute runs on every Pick move but the map regions rarely change in
+        # between; the caches live at module scope because this handler instance
+        # only lives for one evaluation
+        self.__cache = _get_map_cache(computation._computation.uuid)
 
         def create_panel_widget(ui: Facade.UserInterface, document_controller: Facade.DocumentWindow) -> Facade.ColumnWidget:
             def select_button_clicked() -> None:
@@ -37,6 +305,7 @@ class Map4D:
                     pass
                 for graphic in graphics:
                     self.computation._computation.insert_item_into_objects('map_regions', 0, Symbolic.make_item(graphic._graphic))
+                self.__cache.mask_sig = None  # force a mask rebuild on the next execute
 
             column = ui.create_column_widget()
             row = ui.create_row_widget()
@@ -58,30 +327,156 @@ class Map4D:
 
         typing.cast(typing.Any, self.computation._computation).create_panel_widget = create_panel_widget
 
+    def __get_mask_runs(self, mask_data: _DataArrayType) -> _DataArrayType:
+        # the (start, end) pairs of the contiguous runs of the raveled mask, cached
+        # per mask; diffing against zero-padded edges finds every boundary in one pass
+        mask_runs = self.__cache.mask_runs
+        if mask_runs is None:
+            bounds = np.flatnonzero(np.diff(mask_data.ravel(), prepend=np.uint8(0), append=np.uint8(0)))
+            mask_runs = bounds.reshape(-1, 2)
+            self.__cache.mask_runs = mask_runs
+        return mask_runs
+
     def execute(self, src: Facade.DataSource | None = None, map_regions: typing.Sequence[Graphics.Graphic] | None = None, **kwargs: typing.Any) -> None:
         assert src is not None
         assert map_regions is not None
         assert src.xdata
         src_xdata = src.xdata
-        data = np.reshape(src_xdata.data, src_xdata.data_shape[:2] + (-1,))  # flatten the last two dimensions
-        assert data is not None
-        mask_data = np.zeros(src_xdata.data_shape[2:], dtype=np.bool_)
-        for region in map_regions:
-            mask_data = np.logical_or(mask_data, region.get_mask(src_xdata.data_shape[2:]))
-        if mask_data.any():
-            ind = np.arange(mask_data.size)[mask_data.ravel()]
-            new_data = np.sum(data[..., ind], axis=(-1))
-            # y = np.unique(np.indices(mask_data.shape)[0][mask_data])
-            # x = np.unique(np.indices(mask_data.shape)[1][mask_data])
-            # new_data = np.sum(xdata.data[..., x][..., y, :], axis=(-2, -1))
+        arr = src_xdata.data
+        if not arr.flags.c_contiguous:
+            arr = np.ascontiguousarray(arr)
+        data = arr.reshape(arr.shape[0], arr.shape[1], -1)  # flatten the last two dimensions without copying
+        src_sig = (src_xdata.data_shape, str(data.dtype), src_xdata.timestamp)
+        cache = self.__cache
+        if cache.data_T_sig is not None and cache.data_T_sig != src_sig:
+            # the source changed; the detector-major cache no longer applies
+            cache.data_T = None
+            cache.data_T_sig = None
+        detector_shape = src_xdata.data_shape[2:]
+        # the signature is content-based so it is sensitive to geometry edits and
+        # stable across the per-evaluation region snapshots
+        mask_sig = (detector_shape, tuple(_region_signature(region) for region in map_regions))
+        if mask_sig != cache.mask_sig:
+            # accumulate the region masks in place into a single uint8 buffer instead
+            # of allocating a fresh boolean array per region
+            mask_data = np.zeros(detector_shape, dtype=np.uint8)
+            descriptors: typing.List[_RegionDescriptor] = []
+            for region in map_regions:
+                descriptor = _describe_region(mask_data.shape, region)
+                if descriptor is not None:
+                    descriptors.append(descriptor)
+                else:
+                    # get_mask returns float64 (or int) masks depending on the shape,
+                    # so compare against zero to get ORable booleans
+                    np.bitwise_or(mask_data, region.get_mask(detector_shape) != 0, out=mask_data)
+            if descriptors:
+                if numba is not None:
+                    # rasterize all simple shapes in one parallel pass over the rows
+                    _fill_union_mask(np.array(descriptors, dtype=np.float64), mask_data)
+                else:
+                    for descriptor in descriptors:
+                        _fill_descriptor_mask(mask_data, descriptor)
+            cache.mask_sig = mask_sig
+            cache.mask_data = mask_data
+            cache.mask_count = int(mask_data.sum())
+            cache.mask_idx = None
+            cache.mask_weights = None
+            cache.mask_runs = None
+        else:
+            assert cache.mask_data is not None
+            mask_data = cache.mask_data
+        mask_count = cache.mask_count
+        # detectors deliver 8/16-bit counts; reducing them at int64 instead of a
+        # promoted float avoids widening the streamed data while keeping the
+        # accumulator overflow-safe (int32 wraps already at a 512² uint16 frame)
+        is_integer = np.issubdtype(data.dtype, np.integer)
+        sum_dtype = np.dtype(np.int64) if is_integer else data.dtype
+        out = cache.out
+        if out is None or out.shape != data.shape[:2] or out.dtype != sum_dtype:
+            out = np.empty(data.shape[:2], dtype=sum_dtype)
+            cache.out = out
+        if mask_count == 0 or mask_count == mask_data.size:
+            # no mask or a mask covering the whole detector: sum all pixels directly
+            new_data = data.sum(axis=-1, dtype=sum_dtype, out=out)
+        elif (mask_runs := self.__get_mask_runs(mask_data)).shape[0] <= _MAX_MASK_RUNS:
+            # the raveled mask is a handful of contiguous runs (e.g. one rectangle
+            # ROI): sum each run as a plain slice, no index list or weights needed
+            out[...] = 0
+            for start, end in mask_runs:
+                np.add(out, data[..., start:end].sum(axis=-1, dtype=sum_dtype), out=out)
+            new_data = out
+        elif mask_count < _SPARSE_MASK_DENSITY * mask_data.size:
+            # sparse mask: only touch the selected detector pixels
+            idx = cache.mask_idx
+            if idx is None:
+                idx = np.flatnonzero(mask_data)
+                if mask_data.size < 2 ** 31:
+                    # int32 indices halve the index-array bandwidth in the gather
+                    idx = idx.astype(np.int32, copy=False)
+                cache.mask_idx = idx
+            data_T = cache.data_T if cache.data_T_sig == src_sig else None
+            if data_T is None and src_sig == cache.last_src_sig and data.nbytes <= _SOA_CACHE_MAX_BYTES:
+                # the same source is being mapped repeatedly (live Pick updates), so
+                # pay once for a detector-major copy; sparse masks then reduce over
+                # contiguous (Ny, Nx) planes instead of strided per-position gathers
+                if numba is not None and data.dtype.name in _SUM_MASKED_DTYPES:
+                    data_T = np.empty((data.shape[-1],) + data.shape[:2], dtype=data.dtype)
+                    _tiled_transpose_to_soa(data, data_T)
+                else:
+                    data_T = np.ascontiguousarray(data.transpose(2, 0, 1))
+                cache.data_T = data_T
+                cache.data_T_sig = src_sig
+            if data_T is not None:
+                # accumulate the selected planes in place rather than gathering
+                # data_T[idx] into a (|idx|, Ny, Nx) temporary
+                out[...] = 0
+                for i in idx:
+                    np.add(out, data_T[i], out=out)
+                new_data = out
+            elif numba is not None and data.dtype.name in _SUM_MASKED_DTYPES and idx.dtype == np.int32:
+                # the masked sum is embarrassingly parallel across the scan grid, so
+                # hand it to the multi-threaded kernel when a signature exists
+                _sum_masked(data, idx, out)
+                new_data = out
+            else:
+                new_data = data[..., idx].sum(axis=-1, dtype=sum_dtype, out=out)
+        else:
+            # dense mask: a dot product against the mask weights streams the data once
+            # (BLAS GEMV) instead of materializing a gathered temporary
+            weights = cache.mask_weights
+            if weights is None or weights.dtype != sum_dtype:
+                weights = mask_data.ravel().astype(sum_dtype, copy=False)
+                cache.mask_weights = weights
+            if cupy is not None and data.nbytes >= _CUPY_MIN_BYTES:
+                # large datasets amortize the transfer; only the small map comes
+                # back. asnumpy has no out parameter, so cast explicitly instead
+                # of relying on it to match the accumulator dtype
+                out[...] = cupy.asnumpy(cupy.tensordot(cupy.asarray(data), cupy.asarray(weights), axes=([-1], [0]))).astype(sum_dtype, copy=False)
+                new_data = out
+            else:
+                # states the contraction explicitly; optimize=True lets numpy dispatch
+                # the "yxd,d->yx" reduction to BLAS GEMV
+                new_data = np.einsum("yxd,d->yx", data, weights, out=out, optimize=True)
+        cache.last_src_sig = src_sig
+        dimensional_calibrations = src_xdata.dimensional_calibrations[:2]
+        intensity_calibration = src_xdata.intensity_calibration
+        new_xdata = cache.new_xdata
+        if new_xdata is not None and new_xdata.data is not None \
+                and new_xdata.data.shape == new_data.shape and new_xdata.data.dtype == new_data.dtype \
+                and list(new_xdata.dimensional_calibrations) == list(dimensional_calibrations) \
+                and new_xdata.intensity_calibration == intensity_calibration:
+            # same shape, dtype and calibrations: refresh the cached wrapper from a
+            # copy; the scratch buffer must never be handed to the document model,
+            # which would let later evaluations mutate the stored data in place
+            new_xdata.data[...] = new_data
         else:
-            new_data = np.sum(data, axis=-1)
-        self.__new_xdata = DataAndMetadata.new_data_and_metadata(new_data,
-                                                                 dimensional_calibrations=src_xdata.dimensional_calibrations[:2],
-                                                                 intensity_calibration=src_xdata.intensity_calibration)
+            cache.new_xdata = DataAndMetadata.new_data_and_metadata(new_data.copy(),
+                                                                    dimensional_calibrations=dimensional_calibrations,
+                                                                    intensity_calibration=intensity_calibration)
 
     def commit(self) -> None:
-        self.computation.set_referenced_xdata('target', self.__new_xdata)
+        if self.__cache.new_xdata:
+            self.computation.set_referenced_xdata('target', self.__cache.new_xdata)
 
 
 class Map4DMenuItem:
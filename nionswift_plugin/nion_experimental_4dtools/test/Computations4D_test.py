@@ -137,6 +137,198 @@ class TestComputations4D(unittest.TestCase):
             self.assertEqual(1, len(display_item.graphics))
             self.assertEqual(1, len(map_display_item.graphics))
 
+    def test_map_4D_analytic_masks_match_get_mask(self) -> None:
+        # the analytic rasterizers must reproduce the Graphics get_mask output
+        # exactly, including the half-pixel center offset and boundary pixels
+        shape = (16, 16)
+        bounds_list = [
+            Geometry.FloatRect.from_tlhw(0.4, 0.3, 0.2, 0.4),
+            Geometry.FloatRect.from_tlhw(0.0, 0.0, 1.0, 1.0),
+            Geometry.FloatRect.from_tlhw(0.25, 0.25, 0.5, 0.5),
+            Geometry.FloatRect.from_tlhw(-0.1, 0.6, 0.5, 0.7),
+            Geometry.FloatRect.from_tlhw(0.5, 0.5, 0.0, 0.0),
+            Geometry.FloatRect.from_tlhw(0.37, 0.21, 0.33, 0.29),
+        ]
+        for bounds in bounds_list:
+            for region in (Graphics.RectangleRegion(bounds, 0.0), Graphics.EllipseRegion(bounds, 0.0)):
+                expected = region.get_mask(shape) != 0
+                descriptor = Map4D._describe_region(shape, region)
+                assert descriptor is not None
+                mask_data = numpy.zeros(shape, dtype=numpy.uint8)
+                with numpy.errstate(divide='ignore', invalid='ignore'):
+                    Map4D._fill_descriptor_mask(mask_data, descriptor)
+                self.assertTrue(numpy.array_equal(mask_data.astype(bool), expected))
+                if Map4D.numba is not None:
+                    mask_data = numpy.zeros(shape, dtype=numpy.uint8)
+                    Map4D._fill_union_mask(numpy.array([descriptor], dtype=numpy.float64), mask_data)
+                    self.assertTrue(numpy.array_equal(mask_data.astype(bool), expected))
+        # rotated shapes must fall back to the generic rasterizer
+        self.assertIsNone(Map4D._describe_region(shape, Graphics.RectangleRegion(bounds_list[0], 0.5)))
+
+    def test_map_4D_strategies_match_plain_sum(self) -> None:
+        # one case per reduction strategy in Map4D.execute: empty mask, full mask,
+        # run-length slices, sparse gather and dense dot product, plus an integer
+        # input; each must agree with the plain numpy reduction over the mask
+        cases: typing.List[typing.Tuple[typing.Any, typing.Tuple[int, int], typing.List[typing.Tuple[typing.Any, Geometry.FloatRect]]]] = [
+            (numpy.float64, (8, 8), []),
+            (numpy.float64, (8, 8), [(Graphics.RectangleGraphic, Geometry.FloatRect.from_tlhw(0.0, 0.0, 1.0, 1.0))]),
+            (numpy.float64, (8, 8), [(Graphics.RectangleGraphic, Geometry.FloatRect.from_tlhw(0.25, 0.25, 0.5, 0.5))]),
+            (numpy.float64, (80, 80), [(Graphics.EllipseGraphic, Geometry.FloatRect.from_tlhw(0.05, 0.45, 0.9, 0.06))]),
+            (numpy.float64, (80, 80), [(Graphics.EllipseGraphic, Geometry.FloatRect.from_tlhw(0.0, 0.1, 1.0, 0.8))]),
+            (numpy.uint16, (8, 8), [(Graphics.RectangleGraphic, Geometry.FloatRect.from_tlhw(0.25, 0.25, 0.5, 0.5))]),
+        ]
+        for dtype, detector_shape, graphic_specs in cases:
+            with create_memory_profile_context() as test_context:
+                document_controller = test_context.create_document_controller_with_application()
+                document_model = document_controller.document_model
+                shape = (4, 4) + detector_shape
+                if numpy.issubdtype(dtype, numpy.integer):
+                    data = numpy.random.randint(0, 1000, shape).astype(dtype)
+                else:
+                    data = numpy.random.randn(*shape).astype(dtype)
+                xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+                data_item = DataItem.new_data_item(xdata)
+                document_model.append_data_item(data_item)
+                display_panel = document_controller.selected_display_panel
+                display_item = document_model.get_display_item_for_data_item(data_item)
+                display_panel.set_display_panel_display_item(display_item)
+                api = Facade.get_api("~1.0", "~1.0")
+                map_regions = []
+                mask = numpy.zeros(detector_shape, dtype=bool)
+                for graphic_type, bounds in graphic_specs:
+                    graphic = graphic_type()
+                    graphic.bounds = bounds
+                    display_item.add_graphic(graphic)
+                    map_regions.append(Facade.Graphic(graphic))
+                    mask |= graphic.get_mask(detector_shape) != 0
+                map_data_item = Map4D.map_4D(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), map_regions)
+                document_model.recompute_all()
+                document_controller.periodic()
+                self.assertFalse(any(computation.error_text for computation in document_model.computations))
+                flat = data.reshape(4, 4, -1)
+                if mask.any() and not mask.all():
+                    expected = flat[..., numpy.flatnonzero(mask)].sum(axis=-1)
+                else:
+                    expected = flat.sum(axis=-1)
+                if numpy.issubdtype(dtype, numpy.integer):
+                    # integer reductions are exact whatever the summation order
+                    self.assertTrue(numpy.array_equal(map_data_item.data, expected))
+                else:
+                    # the blocked/BLAS reductions sum in a different order than the
+                    # gathered baseline, so allow last-ulp float differences
+                    self.assertTrue(numpy.allclose(map_data_item.data, expected, rtol=1e-12, atol=0.0))
+
+    def test_map_4D_recomputes_on_region_and_data_changes(self) -> None:
+        # moving or resizing a map region and replacing the source data must both
+        # invalidate the cached mask and produce a freshly reduced map
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            data = numpy.random.randn(4, 4, 8, 8)
+            xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            display_panel = document_controller.selected_display_panel
+            display_item = document_model.get_display_item_for_data_item(data_item)
+            display_panel.set_display_panel_display_item(display_item)
+            api = Facade.get_api("~1.0", "~1.0")
+            region_graphic = Graphics.RectangleGraphic()
+            region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.4, 0.3, 0.2, 0.4)
+            display_item.add_graphic(region_graphic)
+            map_data_item = Map4D.map_4D(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), [Facade.Graphic(region_graphic)])
+
+            def expected_map(source_data: numpy.typing.NDArray[typing.Any]) -> numpy.typing.NDArray[typing.Any]:
+                mask = region_graphic.get_mask((8, 8)) != 0
+                return source_data.reshape(4, 4, -1)[..., numpy.flatnonzero(mask)].sum(axis=-1)
+
+            # count mask rebuilds by wrapping the descriptor helper, which runs
+            # once per region only when the mask cache misses
+            describe_calls = []
+            original_describe_region = Map4D._describe_region
+
+            def counting_describe_region(*args: typing.Any) -> typing.Any:
+                describe_calls.append(args)
+                return original_describe_region(*args)
+
+            Map4D._describe_region = counting_describe_region  # type: ignore[assignment]
+            try:
+                document_model.recompute_all()
+                document_controller.periodic()
+                self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+                self.assertEqual(1, len(describe_calls))
+                # replace the source data: the map must refresh but the unchanged
+                # regions must hit the cached mask, not rebuild it
+                data = numpy.random.randn(4, 4, 8, 8)
+                data_item.set_xdata(DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2)))
+                document_model.recompute_all()
+                document_controller.periodic()
+                self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+                self.assertEqual(1, len(describe_calls))
+                # move and resize the region: the cached mask key is stale now, so
+                # the mask must be rebuilt for the new geometry
+                region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.1, 0.1, 0.5, 0.25)
+                document_model.recompute_all()
+                document_controller.periodic()
+                self.assertFalse(any(computation.error_text for computation in document_model.computations))
+                self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+                self.assertEqual(2, len(describe_calls))
+            finally:
+                Map4D._describe_region = original_describe_region  # type: ignore[assignment]
+
+    def test_map_4D_detector_major_cache_builds_and_reuses(self) -> None:
+        # a sparse mask over a recurring source must build the detector-major copy
+        # on the second evaluation and keep reusing it while the source is unchanged
+        with create_memory_profile_context() as test_context:
+            document_controller = test_context.create_document_controller_with_application()
+            document_model = document_controller.document_model
+            data = numpy.random.randn(4, 4, 80, 80)
+            xdata = DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2))
+            data_item = DataItem.new_data_item(xdata)
+            document_model.append_data_item(data_item)
+            display_panel = document_controller.selected_display_panel
+            display_item = document_model.get_display_item_for_data_item(data_item)
+            display_panel.set_display_panel_display_item(display_item)
+            api = Facade.get_api("~1.0", "~1.0")
+            # a thin ellipse: sparse enough for the indexed strategies but with too
+            # many mask runs for the slice path
+            region_graphic = Graphics.EllipseGraphic()
+            region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.05, 0.45, 0.9, 0.06)
+            display_item.add_graphic(region_graphic)
+            map_data_item = Map4D.map_4D(api, Facade.DocumentWindow(document_controller), Facade.Display(display_item), [Facade.Graphic(region_graphic)])
+
+            def expected_map(source_data: numpy.typing.NDArray[typing.Any]) -> numpy.typing.NDArray[typing.Any]:
+                mask = region_graphic.get_mask((80, 80)) != 0
+                return source_data.reshape(4, 4, -1)[..., numpy.flatnonzero(mask)].sum(axis=-1)
+
+            document_model.recompute_all()
+            document_controller.periodic()
+            self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+            cache = Map4D._map_caches[document_model.computations[0].uuid]
+            # the first evaluation only records the source; no copy yet
+            self.assertIsNone(cache.data_T)
+            # a region edit forces a second evaluation on the same source, which
+            # builds the copy and reduces over its planes
+            region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.05, 0.43, 0.9, 0.06)
+            document_model.recompute_all()
+            document_controller.periodic()
+            self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+            self.assertIsNotNone(cache.data_T)
+            data_T = cache.data_T
+            # a further evaluation on the same source reuses the copy as is
+            region_graphic.bounds = Geometry.FloatRect.from_tlhw(0.05, 0.41, 0.9, 0.06)
+            document_model.recompute_all()
+            document_controller.periodic()
+            self.assertFalse(any(computation.error_text for computation in document_model.computations))
+            self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+            self.assertIs(data_T, cache.data_T)
+            # replacing the source invalidates the copy
+            data = numpy.random.randn(4, 4, 80, 80)
+            data_item.set_xdata(DataAndMetadata.new_data_and_metadata(data, data_descriptor=DataAndMetadata.DataDescriptor(False, 2, 2)))
+            document_model.recompute_all()
+            document_controller.periodic()
+            self.assertTrue(numpy.allclose(map_data_item.data, expected_map(data), rtol=1e-12, atol=0.0))
+            self.assertIsNot(data_T, cache.data_T)
+
     def test_map_4D_RGB_computation(self) -> None:
         with create_memory_profile_context() as test_context:
             document_controller = test_context.create_document_controller_with_application()